@@ -1,17 +1,88 @@
+import functools
+import hashlib
 import os
 import warnings
 import cv2
 import numpy as np
 import pytesseract
-from pdf2image import convert_from_path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import img2pdf
+import pypdfium2 as pdfium
 from PIL import Image
 from pytesseract import Output
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+import asyncio
 import json
 
+def _bbox_and_crop(rgb, pad_px, white_thr):
+    # Single pass over the page buffer: non-white mask, bbox.
+    # The crop itself is a numpy slice -- a view into rgb, no copy.
+    # No luminance weighting needed just to find content: a pixel is
+    # non-white when any channel dips below white_thr, i.e. min < thr.
+    mask = rgb.min(axis=2) < white_thr
+    rows = mask.any(axis=1)
+    cols = mask.any(axis=0)
+    if not rows.any() or not cols.any():
+        return rgb, None
+    y1 = int(np.argmax(rows))
+    y2 = len(rows) - 1 - int(np.argmax(rows[::-1]))
+    x1 = int(np.argmax(cols))
+    x2 = len(cols) - 1 - int(np.argmax(cols[::-1]))
+    y1 = max(y1 - pad_px, 0)
+    x1 = max(x1 - pad_px, 0)
+    y2 = min(y2 + pad_px, rgb.shape[0] - 1)
+    x2 = min(x2 + pad_px, rgb.shape[1] - 1)
+    return rgb[y1:y2, x1:x2], (x1, y1, x2, y2)
+
+def _process_one_page(i, pdf_path, dpi, pad_px, white_thr, images_dir, needs_ocr=True):
+    # Runs in a worker process: render only page i here instead of
+    # shipping the full-size bitmap over IPC. pdfium renders straight
+    # into an HxWx3 uint8 buffer, no Poppler subprocess and no PIL copy.
+    pdf = pdfium.PdfDocument(pdf_path)
+    page = pdf[i - 1].render(scale=dpi / 72, rev_byteorder=True).to_numpy()
+    pdf.close()
+    print(f"Processing page {i}...")
+    if needs_ocr:
+        try:
+            # OSD only needs ~75 DPI to spot 90-degree rotations; probe a
+            # quarter-size copy and keep the full-resolution page untouched.
+            small = cv2.resize(page,
+                               (max(1, page.shape[1] // 4), max(1, page.shape[0] // 4)),
+                               interpolation=cv2.INTER_AREA)
+            d = pytesseract.image_to_osd(small, output_type=Output.DICT)
+            angle = int(d.get("rotate", 0))
+            if angle:
+                print(f"Rotating page {i} by {360 - angle} degrees.")
+                # OSD angles are multiples of 90, so this is a pure memory
+                # transpose -- no resampling, no new canvas allocation.
+                rotation = {90: cv2.ROTATE_90_CLOCKWISE,
+                            180: cv2.ROTATE_180,
+                            270: cv2.ROTATE_90_COUNTERCLOCKWISE}.get(angle)
+                if rotation is not None:
+                    page = cv2.rotate(page, rotation)
+                else:
+                    page = np.array(Image.fromarray(page).rotate(360 - angle, expand=True))
+        except pytesseract.TesseractError as e:
+            print(f"Skipping OSD on page {i}: {e}")
+            print(f"[Using original image for page {i} without rotation.")
+
+        page, box = _bbox_and_crop(page, pad_px, white_thr)
+        if box is not None:
+            x1, y1, x2, y2 = box
+            print(f"Cropping page {i} to coordinates: x1={x1}, y1={y1}, x2={x2}, y2={y2}")
+    else:
+        print(f"Page {i} has an embedded text layer; skipping OSD and crop.")
+    save_path = os.path.join(images_dir, f"page_{i}_processed.png")
+    # These PNGs are transient (re-read by Azure DI / pandoc minutes
+    # later), so trade ~15% file size for a ~4x faster level-1 deflate.
+    cv2.imwrite(save_path, cv2.cvtColor(page, cv2.COLOR_RGB2BGR),
+                [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    print(f"Saved processed page {i} to {save_path}")
+    return save_path, page.shape[1], page.shape[0]
+
 class PDFProcessor:
-    def __init__(self, pdf_path, endpoint, key, dpi=300, images_dir="images", fig_dir="figures", corrected_pdf="corrected.pdf", json_path="analysis.json", output_txt="output.txt", pad_px=20, white_thr=245):
+    def __init__(self, pdf_path, endpoint, key, dpi=300, images_dir="images", fig_dir="figures", corrected_pdf="corrected.pdf", json_path="analysis.json", output_txt="output.txt", pad_px=20, white_thr=245, min_text_chars=50, cache_dir="di_cache"):
         self.pdf_path = pdf_path
         self.endpoint = endpoint
         self.key = key
@@ -23,71 +94,98 @@ class PDFProcessor:
         self.output_txt = output_txt
         self.pad_px = pad_px
         self.white_thr = white_thr
-        self.processed_images = []
+        self.min_text_chars = min_text_chars
+        self.cache_dir = cache_dir
+        self.needs_ocr = {}
+        self.page_paths = []
+        self._page_sizes = []
         self.layout = {}
         self.fig_paths_by_idx = {}
         os.makedirs(self.images_dir, exist_ok=True)
         os.makedirs(self.fig_dir, exist_ok=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
         warnings.simplefilter("ignore", Image.DecompressionBombWarning)
         Image.MAX_IMAGE_PIXELS = None
-        self.client = DocumentIntelligenceClient(self.endpoint, AzureKeyCredential(self.key))
 
     def fix_pdf(self):
         print("Starting PDF fixing...")
-        pages = convert_from_path(self.pdf_path, dpi=self.dpi)
-        total_pages = len(pages)
+        pdf = pdfium.PdfDocument(self.pdf_path)
+        total_pages = len(pdf)
+        # Pages that already carry a machine-readable text layer don't need
+        # the OSD probe or the whitespace crop: detection costs milliseconds,
+        # OSD costs seconds per page.
+        for i in range(1, total_pages + 1):
+            text = pdf[i - 1].get_textpage().get_text_bounded()
+            self.needs_ocr[i] = len(text.strip()) < self.min_text_chars
+        pdf.close()
+        digital_pages = total_pages - sum(self.needs_ocr.values())
+        if digital_pages:
+            print(f"{digital_pages} of {total_pages} pages have an embedded text layer; skipping OSD for them.")
         print(f"Fixing PDF: processing {total_pages} pages...")
-        out_pages = []
-        for i, page in enumerate(pages, 1):
-            print(f"Processing page {i}...")
-            try:
-                d = pytesseract.image_to_osd(page, output_type=Output.DICT)
-                angle = int(d.get("rotate", 0))
-                if angle:
-                    print(f"Rotating page {i} by {360 - angle} degrees.")
-                    page = page.rotate(360 - angle, expand=True)
-            except pytesseract.TesseractError as e:
-                print(f"Skipping OSD on page {i}: {e}")
-                print(f"[Using original image for page {i} without rotation.")
-
-            g = cv2.cvtColor(np.array(page), cv2.COLOR_RGB2GRAY)
-            r_mean = g.mean(axis=1)
-            c_mean = g.mean(axis=0)
-            r_idx = np.where(r_mean < self.white_thr)[0]
-            c_idx = np.where(c_mean < self.white_thr)[0]
-            if r_idx.size > 0 and c_idx.size > 0:
-                y1, y2 = r_idx[0], r_idx[-1]
-                x1, x2 = c_idx[0], c_idx[-1]
-                y1 = max(y1 - self.pad_px, 0)
-                x1 = max(x1 - self.pad_px, 0)
-                y2 = min(y2 + self.pad_px, g.shape[0] - 1)
-                x2 = min(x2 + self.pad_px, g.shape[1] - 1)
-                print(f"Cropping page {i} to coordinates: x1={x1}, y1={y1}, x2={x2}, y2={y2}")
-                page = page.crop((x1, y1, x2, y2))
-            save_path = os.path.join(self.images_dir, f"page_{i}_processed.png")
-            page.save(save_path, "PNG")
-            print(f"Saved processed page {i} to {save_path}")
-            
-            out_pages.append(page)
-        if out_pages:
-            out_pages[0].save(self.corrected_pdf, save_all=True, append_images=out_pages[1:], dpi=(self.dpi, self.dpi))
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [
+                executor.submit(_process_one_page, i, self.pdf_path, self.dpi,
+                                self.pad_px, self.white_thr, self.images_dir,
+                                self.needs_ocr[i])
+                for i in range(1, total_pages + 1)
+            ]
+            # Collect in submission order to keep PDF page order.
+            results = [f.result() for f in futures]
+        # Only paths and sizes stay resident; page pixels live on disk and
+        # are reloaded on demand in analyze_pdf. Peak RSS no longer scales
+        # with page count.
+        self.page_paths = [path for path, _, _ in results]
+        self._page_sizes = [(w, h) for _, w, h in results]
+        if self.page_paths:
+            # img2pdf embeds the PNG streams as-is, so the pages saved
+            # above are not re-encoded a second time for the PDF container.
+            layout_fun = img2pdf.get_fixed_dpi_layout_fun((self.dpi, self.dpi))
+            with open(self.corrected_pdf, "wb") as f:
+                f.write(img2pdf.convert(self.page_paths, layout_fun=layout_fun))
             print(f"Corrected PDF saved to {self.corrected_pdf}")
-        self.processed_images = out_pages
         print("PDF fixing completed.")
 
-    def analyze_pdf(self):
+    # Pages with several figures would otherwise be decoded once per
+    # figure; a small thread-safe LRU keeps the hot pages around without
+    # re-growing memory with the page count.
+    @functools.lru_cache(maxsize=8)
+    def _load_page_array(self, pg):
+        # Pages are not kept resident after fix_pdf (see there); decode the
+        # saved PNG on demand. cv2.imread returns BGR, which is what
+        # cv2.imwrite expects back, so no channel shuffle is needed.
+        return cv2.imread(self.page_paths[pg - 1])
+
+    async def analyze_pdf(self):
         print("Starting PDF analysis...")
+        model_id = "prebuilt-layout"
+        # Re-runs on an unchanged corrected.pdf (prompt tweaks, pandoc
+        # retries) should not pay for another Azure round-trip. Hash the
+        # file incrementally; the bytes never need to sit in memory.
         with open(self.corrected_pdf, "rb") as f:
-            body = f.read()
-        print("Analyzing PDF with Azure Document Intelligence...")
-        poller = self.client.begin_analyze_document(
-            model_id="prebuilt-layout",
-            body=body,
-            content_type="application/pdf"
-        )
-        result = poller.result()
-        layout = result.as_dict()
-        total_pages = len(self.processed_images)
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        cache_path = os.path.join(self.cache_dir, f"{digest}_{model_id}.json")
+        if os.path.exists(cache_path):
+            print(f"Using cached Azure analysis from {cache_path}")
+            with open(cache_path, "r", encoding="utf-8") as cf:
+                layout = json.load(cf)
+        else:
+            print("Analyzing PDF with Azure Document Intelligence...")
+            async with DocumentIntelligenceClient(self.endpoint, AzureKeyCredential(self.key)) as client:
+                # Pass the file object so the transport chunk-uploads it
+                # instead of holding the whole PDF on the Python heap.
+                with open(self.corrected_pdf, "rb") as f:
+                    poller = await client.begin_analyze_document(
+                        model_id=model_id,
+                        body=f,
+                        content_type="application/pdf"
+                    )
+                    result = await poller.result()
+            layout = result.as_dict()
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as cf:
+                json.dump(layout, cf)
+            os.replace(tmp_path, cache_path)
+        total_pages = len(self._page_sizes)
         existing = {p["pageNumber"]: p for p in layout.get("pages", [])}
         full_pages = []
         for pg in range(1, total_pages + 1):
@@ -97,8 +195,8 @@ class PDFProcessor:
                 full_pages.append({
                     "pageNumber": pg,
                     "angle": 0,
-                    "width": self.processed_images[pg-1].width / self.dpi,
-                    "height": self.processed_images[pg-1].height / self.dpi,
+                    "width": self._page_sizes[pg-1][0] / self.dpi,
+                    "height": self._page_sizes[pg-1][1] / self.dpi,
                     "unit": "inch",
                     "words": [],
                     "lines": []
@@ -111,71 +209,85 @@ class PDFProcessor:
         pages_meta = {p["pageNumber"]: p for p in layout.get("pages", [])}
         figures = layout.get("figures", [])
         print("Extracting figures...")
-        for idx, fig in enumerate(figures):
-            region = fig.get("boundingRegions", [])[0]
-            pg = region.get("pageNumber")
-            meta = pages_meta.get(pg, {})
-            Wj, Hj = meta.get("width", 1), meta.get("height", 1)
-            coords = region.get("boundingBox", region.get("polygon", []))
-            xs, ys = coords[0::2], coords[1::2]
-            x0f, x1f = min(xs)/Wj, max(xs)/Wj
-            y0f, y1f = min(ys)/Hj, max(ys)/Hj
-            img = self.processed_images[pg - 1]
-            Wp, Hp = img.size
-            x0, x1 = int(x0f * Wp), int(x1f * Wp)
-            y0, y1 = int(y0f * Hp), int(y1f * Hp)
-            x0, x1 = max(0, x0), min(Wp, x1)
-            y0, y1 = max(0, y0), min(Hp, y1)
-            if x1 > x0 and y1 > y0:
-                crop = img.crop((x0, y0, x1, y1))
+        crop_tasks = []
+        if figures:
+            # SoA layout: per-page dimension arrays built once, then the
+            # inch->fraction->pixel mapping for every figure in a handful
+            # of broadcast passes instead of Python math per figure.
+            page_w_in = np.array([pages_meta.get(pg, {}).get("width", 1)
+                                  for pg in range(1, total_pages + 1)], dtype=np.float64)
+            page_h_in = np.array([pages_meta.get(pg, {}).get("height", 1)
+                                  for pg in range(1, total_pages + 1)], dtype=np.float64)
+            page_px = np.asarray(self._page_sizes, dtype=np.int64)
+            regions = [fig.get("boundingRegions", [])[0] for fig in figures]
+            fig_pages = np.array([r.get("pageNumber") for r in regions], dtype=np.int64)
+            fig_polys = np.array([r.get("boundingBox", r.get("polygon", []))
+                                  for r in regions], dtype=np.float64)
+            xs, ys = fig_polys[:, 0::2], fig_polys[:, 1::2]
+            Wj, Hj = page_w_in[fig_pages - 1], page_h_in[fig_pages - 1]
+            Wp, Hp = page_px[fig_pages - 1, 0], page_px[fig_pages - 1, 1]
+            x0 = np.maximum((xs.min(axis=1) / Wj * Wp).astype(np.int64), 0)
+            x1 = np.minimum((xs.max(axis=1) / Wj * Wp).astype(np.int64), Wp)
+            y0 = np.maximum((ys.min(axis=1) / Hj * Hp).astype(np.int64), 0)
+            y1 = np.minimum((ys.max(axis=1) / Hj * Hp).astype(np.int64), Hp)
+            for idx in map(int, np.flatnonzero((x1 > x0) & (y1 > y0))):
+                pg = int(fig_pages[idx])
                 out_png = os.path.join(self.fig_dir, f"figure_{pg}_{idx}.png")
-                crop.save(out_png)
+                crop_tasks.append((idx, pg,
+                                   (int(x0[idx]), int(y0[idx]), int(x1[idx]), int(y1[idx])),
+                                   out_png))
                 self.fig_paths_by_idx[idx] = out_png
-                print(f"Saved figure {idx} to {out_png}")
+
+        def save_crop(task):
+            idx, pg, (x0, y0, x1, y1), out_png = task
+            crop = self._load_page_array(pg)[y0:y1, x0:x1]
+            cv2.imwrite(out_png, crop, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            print(f"Saved figure {idx} to {out_png}")
+
+        # libpng encoding releases the GIL, so the PNG compression of
+        # separate figures overlaps across threads.
+        if crop_tasks:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(save_crop, crop_tasks))
         print(f"Extracted {len(self.fig_paths_by_idx)} figures.")
         print("PDF analysis completed.")
 
     def generate_text(self):
         print("Starting text generation...")
-        def get_bounding_box_center(bounding_region):
-            page = bounding_region["pageNumber"]
-            polygon = bounding_region["polygon"]
-            xs, ys = polygon[0::2], polygon[1::2]
-            x_center = sum(xs) / len(xs)
-            y_center = sum(ys) / len(ys)
-            return page, y_center, x_center
         layout = self.layout
         paragraphs = layout.get("paragraphs", [])
         figures = layout.get("figures", [])
-        elements = []
-        for para_idx, para in enumerate(paragraphs):
+        # Structure-of-arrays: parallel page/polygon arrays plus a content
+        # list, so the center math and the reading-order sort run as
+        # vectorized numpy passes instead of Python per element.
+        pages, polygons, contents = [], [], []
+        for para in paragraphs:
             if not para.get("boundingRegions"):
                 continue
-            page, y_center, x_center = get_bounding_box_center(para["boundingRegions"][0])
-            elements.append({
-                "type": "paragraph",
-                "index": para_idx,
-                "page": page,
-                "y_center": y_center,
-                "x_center": x_center,
-                "content": para.get("content", "")
-            })
+            region = para["boundingRegions"][0]
+            pages.append(region["pageNumber"])
+            polygons.append(region["polygon"])
+            contents.append(para.get("content", ""))
         for fig_idx, fig in enumerate(figures):
             if not fig.get("boundingRegions"):
                 continue
-            page, y_center, x_center = get_bounding_box_center(fig["boundingRegions"][0])
-            elements.append({
-                "type": "figure",
-                "index": fig_idx,
-                "page": page,
-                "y_center": y_center,
-                "x_center": x_center,
-                "content": f"[FIGURE: {self.fig_paths_by_idx.get(fig_idx, '')}]"
-            })
-        elements.sort(key=lambda e: (e["page"], e["y_center"], e["x_center"]))
+            region = fig["boundingRegions"][0]
+            pages.append(region["pageNumber"])
+            polygons.append(region["polygon"])
+            contents.append(f"[FIGURE: {self.fig_paths_by_idx.get(fig_idx, '')}]")
+        if polygons:
+            # Azure polygons are 4-vertex quads -> an (N, 8) array; the
+            # x/y centers for every element come from two reductions.
+            poly_arr = np.asarray(polygons, dtype=np.float64)
+            x_centers = poly_arr[:, 0::2].mean(axis=1)
+            y_centers = poly_arr[:, 1::2].mean(axis=1)
+            order = np.lexsort((x_centers, y_centers,
+                                np.asarray(pages, dtype=np.int32)))
+        else:
+            order = []
         with open(self.output_txt, "w", encoding="utf-8") as out:
-            for element in elements:
-                out.write(element["content"] + "\n\n")
+            # One buffered write instead of a write call per element.
+            out.writelines(contents[i] + "\n\n" for i in order)
         print(f"Output text written to {self.output_txt}")
         print("Text generation completed.")
 
@@ -183,7 +295,7 @@ class PDFProcessor:
         print("Starting PDF processing...")
         self.fix_pdf()
         print("PDF fixing completed.")
-        self.analyze_pdf()
+        asyncio.run(self.analyze_pdf())
         print("PDF analysis completed.")
         self.generate_text()
         print("Text generation completed.")
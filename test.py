@@ -1,7 +1,16 @@
+import hashlib
 import os
 import re
 from langchain_openai import AzureChatOpenAI
 
+# Bump whenever the prompt template below changes, so stale cached
+# conversions are not reused.
+PROMPT_VERSION = "1"
+LLM_CACHE_DIR = ".llm_cache"
+
+_FENCE_OPEN = re.compile(r"^```[a-zA-Z]*\n?")
+_FENCE_CLOSE = re.compile(r"```$")
+
 class Config:
     def __init__(self):
         self.azure_endpoint = os.getenv("AZURE_ENDPOINT")
@@ -24,8 +33,8 @@ class Config:
 
 def strip_code_fences(s: str) -> str:
     s = s.strip()
-    s = re.sub(r"^```[a-zA-Z]*\n?", "", s)
-    s = re.sub(r"```$", "", s)
+    s = _FENCE_OPEN.sub("", s)
+    s = _FENCE_CLOSE.sub("", s)
     return s.strip()
 
 def read_text_file(txt_path: str) -> str:
@@ -41,6 +50,19 @@ def read_text_file(txt_path: str) -> str:
 
 def generate_latex(txt_path: str, config: Config) -> str:
     text_content = read_text_file(txt_path)
+    # The same (text, prompt, model) triple always yields the same
+    # conversion job, so cache it on disk: re-runs after a pandoc failure
+    # or pipeline tweak skip the LLM call and its API cost entirely.
+    # Set LLM_CACHE_DISABLE=1 to force a fresh call.
+    cache_enabled = not os.getenv("LLM_CACHE_DISABLE")
+    cache_key = hashlib.sha256(
+        (text_content + PROMPT_VERSION + config.azure_model_name).encode("utf-8")
+    ).hexdigest()
+    cache_path = os.path.join(LLM_CACHE_DIR, f"{cache_key}.tex")
+    if cache_enabled and os.path.exists(cache_path):
+        print(f"Using cached LaTeX from {cache_path}")
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
     print("Initializing AzureChatOpenAI LLM...")
     llm = AzureChatOpenAI(
         deployment_name=config.azure_model_name,
@@ -118,4 +140,10 @@ def generate_latex(txt_path: str, config: Config) -> str:
     raw = ai_resp.content if hasattr(ai_resp, "content") else str(ai_resp)
     latex_content = strip_code_fences(raw)
     print("LLM processing complete. Text converted to LaTeX.")
+    if cache_enabled:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(latex_content)
+        os.replace(tmp_path, cache_path)
     return latex_content
\ No newline at end of file